@@ -1,15 +1,76 @@
 import argparse
-from ipaddress import IPv4Interface, IPv4Network
-from typing import Dict, List
+from ipaddress import IPv4Address, IPv4Interface, IPv4Network
+from typing import Dict, Iterator, List, NamedTuple, Tuple
+from numba import njit, prange
+import numpy as np
 from ruamel.yaml import YAML
-import json
+import orjson
+
+
+class RouteLookup(NamedTuple):
+    channels: List['Channel']
+    interfaces: List['Interface']
+    network_base: np.ndarray
+    network_prefixlen: np.ndarray
+    interface_ip: np.ndarray
+
+
+def merge_routes(group: np.ndarray, base: np.ndarray, prefixlen: np.ndarray, gateway: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Merge neighbouring networks of the same group with the same supernet and gateway,
+    # returning the kept route indices with their (possibly merged) networks.
+    # Routes must be sorted by group and network already.
+    order = np.arange(len(base))
+    base = base.astype(np.int64)
+    prefixlen = prefixlen.astype(np.int64)
+
+    while len(order) > 1:
+        shift = 33 - prefixlen
+        supernet = base >> shift
+        mergeable = (
+            (group[1:] == group[:-1])
+            & (prefixlen[1:] == prefixlen[:-1])
+            & (supernet[1:] == supernet[:-1])
+            & (gateway[1:] == gateway[:-1])
+        )
+        if not mergeable.any():
+            break
+
+        # The merged route keeps the entry of the upper half
+        upper = np.flatnonzero(mergeable) + 1
+        base[upper] = supernet[upper] << shift[upper]
+        prefixlen[upper] -= 1
+
+        keep = np.ones(len(order), np.bool_)
+        keep[upper - 1] = False
+        order = order[keep]
+        base = base[keep]
+        prefixlen = prefixlen[keep]
+        group = group[keep]
+        gateway = gateway[keep]
+
+    return order, base, prefixlen
+
+
+def format_ips(ips: np.ndarray) -> List[str]:
+    octets = (ips.astype(np.int64)[:, None] >> np.array([24, 16, 8, 0])) & 0xff
+    return [f'{a}.{b}.{c}.{d}' for a, b, c, d in octets.tolist()]
+
 
 class NetworkPool:
     def __init__(self, network: IPv4Network, new_prefix: int=28) -> None:
-        self.free_networks = list(network.subnets(new_prefix=new_prefix))
+        # Subnets are handed out in order, so only the next one needs to be tracked
+        self._base = int(network.network_address)
+        self._prefix = new_prefix
+        self._step = 1 << (32 - new_prefix)
+        self._count = 1 << (new_prefix - network.prefixlen)
+        self._cursor = 0
 
     def gen_network(self) -> IPv4Network:
-        return self.free_networks.pop(0)
+        if self._cursor >= self._count:
+            raise IndexError('network pool exhausted')
+        network = IPv4Network((self._base + self._cursor * self._step, self._prefix))
+        self._cursor += 1
+        return network
 
 
 class Node:
@@ -18,6 +79,9 @@ class Node:
         self.component = component
         self.interfaces = []
         self.include_routes = include_routes
+        self.dump = self._dump_with_routes if include_routes else self._dump_no_routes
+        self._routes_cache = None
+        self._simplified_routes_cache = None
 
     def add_interface(self, interface: 'Interface') -> str:
         id = f'i{len(self.interfaces)}'
@@ -30,73 +94,113 @@ class Node:
     def get_short(self) -> str:
         raise NotImplementedError()
 
-    def dump(self) -> Dict:
-        result = {
+    def _dump_no_routes(self, routes: List[Dict]=None) -> Dict:
+        return {
             'id': self.get_id(),
             'device': self.device,
             'component': self.component,
             'interfaces': [interface.dump() for interface in self.interfaces]
         }
 
-        if self.include_routes:
-            result['routes'] = [
+    def _dump_with_routes(self, routes: List[Dict]=None) -> Dict:
+        result = self._dump_no_routes()
+
+        if routes is None:
+            routes = [
                 {
                     'network': str(network),
-                    'gateway': str(gw_interface.get_ip().ip),
+                    'gateway': gw_interface.get_ip_str(),
                     'metric': dist
                 }
-                for network, (interface, gw_interface, dist) in self.get_simplified_routes().items()
+                for network, interface, gw_interface, dist in self._iter_simplified_routes()
                 if interface != gw_interface
             ]
+        result['routes'] = routes
 
         return result
 
     def get_ips(self) -> Dict:
         result = {
             'id': self.get_id(),
-            'interfaces': [str(interface.get_ip().ip) for interface in self.interfaces]
+            'interfaces': [interface.get_ip_str() for interface in self.interfaces]
         }
 
         return result
 
+    def get_route_indices(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        # Shortest route to each channel as (channel, own interface, gateway interface, distance) index arrays
+        lengths = [len(interface.channel.route_src) for interface in self.interfaces]
+        src = np.concatenate([np.empty(0, np.int32)] + [interface.channel.route_src for interface in self.interfaces])
+        out_if = np.concatenate([np.empty(0, np.int32)] + [interface.channel.route_out_if for interface in self.interfaces])
+        dist = np.concatenate([np.empty(0, np.int32)] + [interface.channel.route_dist for interface in self.interfaces])
+        local_if = np.repeat(np.arange(len(self.interfaces), dtype=np.int32), lengths)
+
+        # Stable sort by channel then distance, so ties go to the first interface
+        order = np.lexsort((dist, src))
+        src = src[order]
+        first = np.ones(len(src), np.bool_)
+        first[1:] = src[1:] != src[:-1]
+        order = order[first]
+
+        return src[first], local_if[order], out_if[order], dist[order]
+
     def get_routes(self) -> Dict:
-        routes = {}
-        for interface in self.interfaces:
-            for channel, gw_interface, dist in interface.channel.routes:
-                if channel not in routes.keys() or routes[channel][2] > dist:
-                    routes[channel] = interface, gw_interface, dist
-        return routes
+        if self._routes_cache is not None:
+            return self._routes_cache
 
-    def get_simplified_routes(self) -> Dict:
-        def custom(tuple):
-            return tuple[0]
+        routes = {}
+        src, local_if, out_if, dist = self.get_route_indices()
+        if len(src):
+            channels, interfaces = self.interfaces[0].channel.route_lookup[:2]
+            for s, l, o, d in zip(src.tolist(), local_if.tolist(), out_if.tolist(), dist.tolist()):
+                routes[channels[s]] = self.interfaces[l], interfaces[o], d
 
-        routes = [(channel.network, v) for channel, v in self.get_routes().items()]
-        routes.sort(key=custom)
+        self._routes_cache = routes
+        return routes
 
-        result = []
-        for entry in routes:
-            result.append(entry)
-            while len(result) > 1 and result[-1][0].supernet() == result[-2][0].supernet() and result[-1][1][1] == result[-2][1][1]:
-                a = result.pop()
-                b = result.pop()
-                result.append((a[0].supernet(), a[1]))
+    def _iter_simplified_routes(self) -> Iterator[Tuple[IPv4Network, 'Interface', 'Interface', int]]:
+        src, local_if, out_if, dist = self.get_route_indices()
+        if not len(src):
+            return
+
+        lookup = self.interfaces[0].channel.route_lookup
+        keep, base, prefixlen = merge_routes(
+            np.zeros(len(src), np.int32),
+            lookup.network_base[src],
+            lookup.network_prefixlen[src],
+            out_if
+        )
+        for k, b, p in zip(keep.tolist(), base.tolist(), prefixlen.tolist()):
+            yield IPv4Network((b, p)), self.interfaces[local_if[k]], lookup.interfaces[out_if[k]], int(dist[k])
 
-        return {
-            network: v for network, v in result
-        }
+    def get_simplified_routes(self) -> Dict:
+        if self._simplified_routes_cache is None:
+            self._simplified_routes_cache = {
+                network: (interface, gw_interface, dist)
+                for network, interface, gw_interface, dist in self._iter_simplified_routes()
+            }
+        return self._simplified_routes_cache
 
     def get_additional_networks(self) -> List[IPv4Network]:
         return []
 
 
 class Channel:
+    _next_idx = 0
+
     def __init__(self, id: str, network: IPv4Network, delay: int):
         self.id = id
+        self.idx = Channel._next_idx
+        Channel._next_idx += 1
         self.network = network
         self.delay = delay
         self.interfaces = []
-        self.routes = []
+
+        # Routes to this channel as parallel arrays indexing into route_lookup (channels, interfaces)
+        self.route_src = np.empty(0, np.int32)
+        self.route_out_if = np.empty(0, np.int32)
+        self.route_dist = np.empty(0, np.int32)
+        self.route_lookup = None
 
     @staticmethod
     def auto(node_a: Node, node_b: Node, network: IPv4Network, delay: int=0, id_a: str=None, id_b: str=None):
@@ -120,23 +224,6 @@ class Channel:
 
         return result
 
-    def distribute_route(self):
-        known = set()
-        queue = []
-
-        known.add(self)
-        queue.append((self, 0))
-        while len(queue):
-            cur_channel, cur_dist = queue.pop(0)
-            for in_interface in cur_channel.interfaces:
-                for out_interface in in_interface.node.interfaces:
-                    next_channel = out_interface.channel
-                    if not next_channel in known:
-                        known.add(next_channel)
-                        queue.append((next_channel, cur_dist + 1))
-
-                        next_channel.routes.append((self, out_interface, cur_dist + 1))
-
 
 class Interface:
     def __init__(self, node: Node, channel: Channel, id: str=None):
@@ -148,15 +235,26 @@ class Interface:
             self.id = node.add_interface(self)
         self.channel = channel
         self.offset = channel.add_interface(self)
+        self._ip_int = int(channel.network.network_address) + self.offset + 1
+        self._prefixlen = channel.network.prefixlen
+        self._ip = None
+        self._ip_str = None
 
     def get_ip(self) -> IPv4Interface:
-        return IPv4Interface((self.channel.network[self.offset + 1], self.channel.network.prefixlen))
+        if self._ip is None:
+            self._ip = IPv4Interface((self._ip_int, self._prefixlen))
+        return self._ip
+
+    def get_ip_str(self) -> str:
+        if self._ip_str is None:
+            self._ip_str = str(IPv4Address(self._ip_int))
+        return self._ip_str
 
     def dump(self) -> Dict:
         return {
             'id': self.id,
             'channel': self.channel.id,
-            'ip': self.get_ip().with_prefixlen
+            'ip': f'{self.get_ip_str()}/{self._prefixlen}'
         }
 
 
@@ -165,12 +263,14 @@ class NodeBackbone(Node):
         super().__init__('router', 'simple-router') 
         self.num = num
         self.subnum = subnum
+        self._id = f'backbone{num}.{subnum}'
+        self._short = f'bb{num}.{subnum}'
 
     def get_id(self) -> str:
-        return f'backbone{self.num}.{self.subnum}'
+        return self._id
 
     def get_short(self) -> str:
-        return f'bb{self.num}.{self.subnum}'
+        return self._short
 
 
 class NodeAggregation(Node):
@@ -178,36 +278,41 @@ class NodeAggregation(Node):
         super().__init__('router', 'simple-router')
         self.num = num
         self.subnum = subnum
+        self._id = f'aggregation{num}.{subnum}'
+        self._short = f'agg{num}.{subnum}'
 
     def get_id(self) -> str:
-        return f'aggregation{self.num}.{self.subnum}'
+        return self._id
 
     def get_short(self) -> str:
-        return f'agg{self.num}.{self.subnum}'
+        return self._short
 
 
 class NodeAccess(Node):
     def __init__(self, num: int) -> None:
         super().__init__('router', 'simple-router')
         self.num = num
+        self._id = f'access{num}'
+        self._short = f'acc{num}'
 
     def get_id(self) -> str:
-        return f'access{self.num}'
+        return self._id
 
     def get_short(self) -> str:
-        return f'acc{self.num}'
+        return self._short
 
 
 class NodeUW(Node):
     def __init__(self, num: int) -> None:
         super().__init__('container', 'simple-uw')
         self.num = num
+        self._id = f'uw{num}'
 
     def get_id(self):
-        return f'uw{self.num}'
+        return self._id
 
     def get_short(self):
-        return f'uw{self.num}'
+        return self._id
 
 
 class NodeExternal(Node):
@@ -228,28 +333,62 @@ class NodeExternal(Node):
         return result
 
 
+@njit('UniTuple(int32[:, :], 2)(int32[:], int32[:], int32[:], int64)', cache=True, parallel=True)
+def bfs_all(indptr, nbr_channel, nbr_out_if, count):
+    # Breadth-first search from each channel in parallel, returning (out interface, distance) matrices
+    # indexed by [destination, source], with distance 0 where there is no route
+    out_if = np.zeros((count, count), np.int32)
+    dist = np.zeros((count, count), np.int32)
+
+    for source in prange(count):
+        queue = np.empty(count, np.int32)
+        queue_dist = np.empty(count, np.int32)
+        known = np.zeros(count, np.uint8)
+        head = 0
+        tail = 1
+
+        known[source] = 1
+        queue[0] = source
+        queue_dist[0] = 0
+        while head < tail:
+            cur_channel = queue[head]
+            next_dist = queue_dist[head] + 1
+            head += 1
+            for edge in range(indptr[cur_channel], indptr[cur_channel + 1]):
+                next_channel = nbr_channel[edge]
+                if not known[next_channel]:
+                    known[next_channel] = 1
+                    queue[tail] = next_channel
+                    queue_dist[tail] = next_dist
+                    tail += 1
+
+                    out_if[next_channel, source] = nbr_out_if[edge]
+                    dist[next_channel, source] = next_dist
+
+    return out_if, dist
+
+
 class Topology:
-    backbone_num = 0
-    backbone_nodes: List[NodeBackbone] = []
+    external_prefix = 'ext'
 
-    aggregation_num = 0
-    aggregation_nodes: List[NodeAggregation] = []
+    def __init__(self) -> None:
+        self.backbone_num = 0
+        self.backbone_nodes: List[List[NodeBackbone]] = []
 
-    access_num = 0
-    access_nodes: List[NodeAccess] = []
+        self.aggregation_num = 0
+        self.aggregation_nodes: List[List[NodeAggregation]] = []
 
-    uw_num = 0
-    uw_nodes: List[NodeUW] = []
+        self.access_num = 0
+        self.access_nodes: List[NodeAccess] = []
 
-    external_prefix = 'ext'
-    external_num = 0
-    external_nodes: List[NodeExternal] = []
+        self.uw_num = 0
+        self.uw_nodes: List[NodeUW] = []
 
-    def __init__(self) -> None:
-        pass
+        self.external_num = 0
+        self.external_nodes: List[NodeExternal] = []
 
     def add_backbone(self, length: int, network_pool: NetworkPool, delay: int) -> List[List[Node]]:
-        nodes = []
+        nodes = [None] * length
 
         # Create pairs of backbone nodes (and an internal channel for each pair)
         for i in range(length):
@@ -258,7 +397,7 @@ class Topology:
                 NodeBackbone(cur_num, j) for j in range(2)
             ]
             channel = Channel.auto(inner_nodes[0], inner_nodes[1], network_pool.gen_network())
-            nodes.append(inner_nodes)
+            nodes[i] = inner_nodes
 
         # Backbone node to next backbone node
         for i in range(length):
@@ -361,23 +500,124 @@ class Topology:
 
     def get_channels(self) -> List[Channel]:
         # Create flattened list of all channels
-        channels = set()
+        seen = bytearray(Channel._next_idx)
+        channels = []
         for node in self.get_nodes():
             for interface in node.interfaces:
-                if not interface.channel in channels:
-                    channels.add(interface.channel)
-        return list(channels)
+                if not seen[interface.channel.idx]:
+                    seen[interface.channel.idx] = 1
+                    channels.append(interface.channel)
+        return channels
 
     def dump(self) -> Dict:
+        nodes = self.get_nodes()
+        routes = self.dump_routes(nodes)
         return {
             'version': '1.0',
-            'nodes': [node.dump() for node in self.get_nodes()],
+            'nodes': [node.dump(node_routes) for node, node_routes in zip(nodes, routes)],
             'channels': [channel.dump() for channel in self.get_channels()]
         }
 
+    def dump_routes(self, nodes: List[Node]) -> List[List[Dict]]:
+        # Simplified routes of all nodes, computed in a single pass over one route table
+        result = [None] * len(nodes)
+        routing = [i for i, node in enumerate(nodes) if node.include_routes and node.interfaces]
+        if not routing or nodes[routing[0]].interfaces[0].channel.route_lookup is None:
+            return result
+
+        lookup = nodes[routing[0]].interfaces[0].channel.route_lookup
+        interface_index = {id(interface): i for i, interface in enumerate(lookup.interfaces)}
+        groups, srcs, own_ifs, out_ifs, dists = [], [], [], [], []
+        for group, i in enumerate(routing):
+            node = nodes[i]
+            src, local_if, out_if, dist = node.get_route_indices()
+            own_if = np.array([interface_index[id(interface)] for interface in node.interfaces], np.int32)
+            groups.append(np.full(len(src), group, np.int32))
+            srcs.append(src)
+            own_ifs.append(own_if[local_if])
+            out_ifs.append(out_if)
+            dists.append(dist)
+
+        group = np.concatenate(groups)
+        out_if = np.concatenate(out_ifs)
+        keep, base, prefixlen = merge_routes(
+            group,
+            lookup.network_base[np.concatenate(srcs)],
+            lookup.network_prefixlen[np.concatenate(srcs)],
+            out_if
+        )
+
+        # Routes via the own interface are directly connected
+        gw_if = out_if[keep]
+        direct = np.concatenate(own_ifs)[keep] == gw_if
+        group = group[keep][~direct]
+        networks = format_ips(base[~direct])
+        gateways = format_ips(lookup.interface_ip[gw_if[~direct]])
+        prefixlen = prefixlen[~direct].tolist()
+        metrics = np.concatenate(dists)[keep][~direct].tolist()
+
+        bounds = np.searchsorted(group, np.arange(len(routing) + 1)).tolist()
+        for group, i in enumerate(routing):
+            result[i] = [
+                {
+                    'network': f'{networks[j]}/{prefixlen[j]}',
+                    'gateway': gateways[j],
+                    'metric': metrics[j]
+                }
+                for j in range(bounds[group], bounds[group + 1])
+            ]
+        return result
+
     def distribute_routes(self) -> None:
-        for channel in self.get_channels():
-            channel.distribute_route()
+        for node in self.get_nodes():
+            node._routes_cache = None
+            node._simplified_routes_cache = None
+
+        # Channels are indexed in network order, so route indices sorted by channel are sorted by network
+        channels = sorted(self.get_channels(), key=lambda channel: channel.network)
+        interfaces = [interface for channel in channels for interface in channel.interfaces]
+        channel_index = [0] * Channel._next_idx
+        for i, channel in enumerate(channels):
+            channel_index[channel.idx] = i
+        interface_index = {id(interface): i for i, interface in enumerate(interfaces)}
+
+        # Channels reachable in one hop from each channel (CSR layout), with the interface used to get there
+        indptr = [0]
+        nbr_channel = []
+        nbr_out_if = []
+        for channel in channels:
+            for in_interface in channel.interfaces:
+                for out_interface in in_interface.node.interfaces:
+                    nbr_channel.append(channel_index[out_interface.channel.idx])
+                    nbr_out_if.append(interface_index[id(out_interface)])
+            indptr.append(len(nbr_channel))
+
+        out_if, dist = bfs_all(
+            np.array(indptr, np.int32),
+            np.array(nbr_channel, np.int32),
+            np.array(nbr_out_if, np.int32),
+            len(channels)
+        )
+
+        # Split routes into per-destination arrays
+        dst, src = np.nonzero(dist)
+        src = src.astype(np.int32)
+        out_if = out_if[dst, src]
+        dist = dist[dst, src]
+        bounds = np.searchsorted(dst, np.arange(len(channels) + 1)).tolist()
+        route_lookup = RouteLookup(
+            channels,
+            interfaces,
+            np.array([int(channel.network.network_address) for channel in channels], np.int64),
+            np.array([channel.network.prefixlen for channel in channels], np.int64),
+            np.array([interface._ip_int for interface in interfaces], np.int64)
+        )
+        for i, channel in enumerate(channels):
+            start, end = bounds[i], bounds[i + 1]
+            channel.route_src = src[start:end]
+            channel.route_out_if = out_if[start:end]
+            channel.route_dist = dist[start:end]
+            channel.route_lookup = route_lookup
 
 
 def gen_topology_small() -> Topology:
@@ -404,7 +644,7 @@ def gen_topology_small() -> Topology:
 def gen_topology(backbone_length: int, aggregation_length: int, access_length: int) -> Topology:
     topology = Topology()
 
-    network_pool = backbone_pool = NetworkPool(IPv4Network('10.96.0.0/16'))
+    network_pool = NetworkPool(IPv4Network('10.96.0.0/16'))
 
     backbone = topology.add_backbone(backbone_length, network_pool, 25)
     for i in range(backbone_length):
@@ -426,17 +666,16 @@ def gen_topology(backbone_length: int, aggregation_length: int, access_length: i
 
 def write_topology_file(topology, topology_file) -> None:
     with open(topology_file, 'w') as file:
-        yaml = YAML()
+        # The topology is generated, so the safe (libyaml) emitter is enough; keep key order and block style
+        yaml = YAML(typ='safe')
+        yaml.default_flow_style = False
+        yaml.sort_base_mapping_type_on_output = False
         yaml.dump(topology.dump(), file)
 
 def write_uw_ip_file(topology, uw_ip_file) -> None:
-    output = []
-    for node_object in [topology.get_uw_nodes()]:
-        for node in node_object:
-            output.append(node.get_ips())
-    with open(uw_ip_file, 'w') as file:
-        json.dump(output, file, ensure_ascii=False)
-    file.close()
+    output = [node.get_ips() for node in topology.uw_nodes]
+    with open(uw_ip_file, 'wb') as file:
+        file.write(orjson.dumps(output))
 
 def main() -> None:
     parser = argparse.ArgumentParser()
@@ -466,7 +705,7 @@ def main() -> None:
         for route_k, route_v in node.get_simplified_routes().items():
             interface, gw_interface, dist = route_v
             if interface != gw_interface:
-                print(route_k, 'via', gw_interface.get_ip().ip, 'dist', dist)
+                print(route_k, 'via', gw_interface.get_ip_str(), 'dist', dist)
 
 
 if __name__ == '__main__':